@@ -1,9 +1,18 @@
-import os, json, re, datetime, asyncio
+import os, json, re, datetime, asyncio, logging, random, string, math
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, asdict
 from typing import List
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import httpx
+import orjson
+
+try:
+    import hyperscan
+except ImportError:  # optional; extract_entities falls back to the pure-re scan
+    hyperscan = None
 
 # -------------------------------------------------------------------
 # Setup
@@ -12,12 +21,42 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = os.getenv("MODEL", "gpt-4o-mini")  # safe default
 # CRM / webhook configuration
-CRM_WEBHOOK_URL = os.getenv("CRM_WEBHOOK_URL", "")
-CRM_API_KEY = os.getenv("CRM_API_KEY", "")
+CRM_WEBHOOK_URL = os.getenv("CRM_WEBHOOK_URL", "").strip()
+CRM_API_KEY = os.getenv("CRM_API_KEY", "").strip()
+
+logger = logging.getLogger(__name__)
 
+# Strong refs to in-flight background CRM posts (the event loop only keeps weak ones)
+_crm_tasks: set[asyncio.Task] = set()
+CRM_SHUTDOWN_TIMEOUT = 5.0  # seconds to let queued CRM posts finish on shutdown
 
 
-app = FastAPI(title="Insurance Lead Qualifier")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled HTTP/2 client for OpenAI + CRM so connections are reused and multiplexed
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        timeout=httpx.Timeout(30.0, connect=5.0),
+    )
+    try:
+        yield
+    finally:
+        # Give queued CRM posts a bounded chance to finish before the client goes away
+        if _crm_tasks:
+            _, pending = await asyncio.wait(_crm_tasks, timeout=CRM_SHUTDOWN_TIMEOUT)
+            if pending:
+                logger.warning("Cancelling %d unfinished CRM posts at shutdown", len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        await app.state.http.aclose()
+
+app = FastAPI(
+    title="Insurance Lead Qualifier",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 SYSTEM = (
     "You are a helpful insurance intake assistant. "
@@ -25,9 +64,10 @@ SYSTEM = (
     "Coverage type (health/life/auto), Existing provider, Budget/month, "
     "Urgency (1–5). Be concise and friendly—one or two questions per turn."
 )
+_SYS_MSG = {"role": "system", "content": SYSTEM}
 
 # -------------------------------------------------------------------
-# Pydantic models
+# Models
 # -------------------------------------------------------------------
 class ChatMessage(BaseModel):
     role: str
@@ -37,7 +77,9 @@ class ChatRequest(BaseModel):
     thread_id: str = Field(..., description="Client-provided thread id to group a conversation")
     messages: List[ChatMessage]
 
-class ExtractedLead(BaseModel):
+# Built from our own extractor output, so it skips Pydantic validation
+@dataclass(slots=True)
+class ExtractedLead:
     name: str | None = None
     age: int | None = None
     state: str | None = None
@@ -50,122 +92,181 @@ class ExtractedLead(BaseModel):
 # -------------------------------------------------------------------
 # OpenAI helper (used as a *fallback*)
 # -------------------------------------------------------------------
-async def call_openai(messages: list[dict]) -> str:
+async def call_openai(client: httpx.AsyncClient, messages: list[dict]) -> str:
     if not OPENAI_API_KEY:
         return "[Missing OPENAI_API_KEY]"
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    headers = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json",
+    }
     payload = {
         "model": MODEL,
         "messages": messages,
+        "stream": True,
     }
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post("https://api.openai.com/v1/chat/completions",
-                                  headers=headers, json=payload)
+        # Read the reply as server-sent events and keep only the content deltas
+        parts = []
+        async with client.stream("POST", "https://api.openai.com/v1/chat/completions",
+                                 headers=headers, content=orjson.dumps(payload)) as r:
             r.raise_for_status()
-            j = r.json()
-            return j["choices"][0]["message"]["content"]
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                choices = orjson.loads(data).get("choices")
+                if choices:
+                    parts.append(choices[0].get("delta", {}).get("content") or "")
+        return "".join(parts)
     except Exception as e:
         # We treat any failure (including 429) as a signal to use local logic
         return f"[LLM error: {e}]"
 
-async def post_to_crm(lead: dict) -> tuple[int, str]:
+# -------------------------------------------------------------------
+# Simple deterministic parser (local logic)
+# -------------------------------------------------------------------
+STATES: frozenset[str] = frozenset({
+    "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "FL", "GA", "HI", "ID", "IL",
+    "IN", "IA", "KS", "KY", "LA", "ME", "MD", "MA", "MI", "MN", "MS", "MO", "MT",
+    "NE", "NV", "NH", "NJ", "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI",
+    "SC", "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY", "DC",
+})
+
+# One pattern per field; the named group holds the captured value. Fields that
+# come in pairs (budget, urgency, state) list the preferred form first, and the
+# fallback is only searched when the preferred form misses.
+# Everything is case-insensitive except the bare ALL-CAPS state code.
+PATTERNS = [
+    ("budget", r"budget[^0-9]{0,12}\$?\s*(?P<budget>[0-9]+(?:\.[0-9]{1,2})?)"),
+    ("budget_any", r"\$\s*(?P<budget_any>[0-9]+(?:\.[0-9]{1,2})?)\s*(?:/mo|per month|monthly)?"),
+    ("age", r"\b(?P<age>1[6-9]|[2-9][0-9])\b"),
+    ("urgency", r"\burgency\b[^0-9]{0,8}(?P<urgency>[1-5])\b"),
+    ("urgency_frac", r"\b(?P<urgency_frac>[1-5])\s*(?:/|of)\s*5\b"),
+    ("state_label", r"\bstate[:\s]+(?P<state_label>[a-z]{2})\b"),
+    ("state_caps", r"(?-i:\b(?P<state_caps>[A-Z]{2})\b)"),
+    # up to four space-separated words; words and separators can't overlap, so no backtracking
+    ("provider", r"provider\s+is\s+(?P<provider>[a-z][a-z0-9\-]{0,40}(?: +[a-z0-9\-]{1,40}){0,3})"),
+]
+
+# ASCII semantics for \b and \s keep the re and Hyperscan paths in agreement.
+_FLAGS = re.IGNORECASE | re.ASCII
+
+# Every compiled pattern the extractor uses, built once at import: one entry
+# per PATTERNS field plus "coverage" (first whole-word coverage keyword).
+REGEX: dict[str, re.Pattern] = {name: re.compile(pat, _FLAGS) for name, pat in PATTERNS}
+REGEX["coverage"] = re.compile(r"\b(life|auto|car|home|renters|health|business)\b", re.IGNORECASE)
+
+_ALL_FIELDS = frozenset(name for name, _ in PATTERNS)
+_UPPER_SET = frozenset(string.ascii_uppercase)
+
+def _build_hyperscan_db():
     """
-    Sends the structured lead to a CRM/webhook.
-    Returns (status_code, short_message). If CRM_WEBHOOK_URL is empty, returns (0, reason).
+    Compile PATTERNS into one Hyperscan database (None if hyperscan is missing).
+    Hyperscan has no capture groups, so the named groups are dropped and it is
+    only asked which fields occur at all (one report per field).
     """
-    if not CRM_WEBHOOK_URL:
-        return 0, "CRM webhook not configured"
-
-    headers = {"Content-Type": "application/json"}
-    if CRM_API_KEY:
-        headers["Authorization"] = f"Bearer {CRM_API_KEY}"
-
-    payload = {
-        "source": "insurance-lead-qualifier",
-        "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
-        "lead": lead,
-    }
+    if hyperscan is None:
+        return None
+    db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    flags = hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_SINGLEMATCH
+    try:
+        db.compile(
+            expressions=[re.sub(r"\(\?P<\w+>", "(", pat).encode() for _, pat in PATTERNS],
+            ids=list(range(len(PATTERNS))),
+            flags=[flags] * len(PATTERNS),
+        )
+    except hyperscan.error:
+        logger.warning("Hyperscan could not compile PATTERNS; using re", exc_info=True)
+        return None
+    return db
 
-    last_err = ""
-    for _ in range(3):  # simple retry
-        try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                r = await client.post(CRM_WEBHOOK_URL, headers=headers, json=payload)
-                return r.status_code, (r.text[:200] if r.text else "")
-        except Exception as e:
-            last_err = str(e)
-            await asyncio.sleep(0.5)
+_HS_DB = _build_hyperscan_db()
+# Below this many characters the fixed cost of a Hyperscan pass (~3us) isn't
+# reliably paid back by the searches it lets us skip.
+_HS_MIN_LEN = 512
 
-    return -1, last_err
+def _on_hs_match(pattern_id, start, end, flags, hits):
+    hits.append(pattern_id)
 
-# -------------------------------------------------------------------
-# Simple deterministic parser (local logic)
-# -------------------------------------------------------------------
-STATES = set("""
-AL AK AZ AR CA CO CT DE FL GA HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO
-MT NE NV NH NJ NM NY NC ND OH OK OR PA RI SC SD TN TX UT VT VA WA WV WI WY DC
-""".split())
-
-def extract_entities(text: str) -> dict:
+def _fields_present(text: str) -> frozenset[str]:
+    """
+    Names of the PATTERNS fields that occur in text. For long text Hyperscan
+    answers this in one pass so the per-field searches below can skip absent
+    fields; otherwise every field is searched.
+    """
+    if _HS_DB is None or len(text) < _HS_MIN_LEN:
+        return _ALL_FIELDS
+    try:
+        data = text.encode()
+    except UnicodeEncodeError:  # lone surrogates; let re deal with it
+        return _ALL_FIELDS
+    hits = []
+    _HS_DB.scan(data, match_event_handler=_on_hs_match, context=hits)
+    return frozenset(PATTERNS[i][0] for i in hits)
+
+# The hot-path pattern methods are bound as default arguments so each call
+# reads them as locals instead of global + attribute lookups.
+def extract_entities(
+    text: str,
+    _coverage=REGEX["coverage"].search,
+    _budget=REGEX["budget"].search,
+    _budget_any=REGEX["budget_any"].search,
+    _age=REGEX["age"].search,
+    _urgency=REGEX["urgency"].search,
+    _urgency_frac=REGEX["urgency_frac"].search,
+    _state_label=REGEX["state_label"].search,
+    _state_caps=REGEX["state_caps"].finditer,
+    _provider=REGEX["provider"].search,
+    _no_upper=_UPPER_SET.isdisjoint,
+) -> dict:
     """
     Very small rule-based extractor for a demo.
     Pulls out: coverage type, budget, age, US state, urgency (1–5), provider.
     Works on free text like:
       "Hi, I need life insurance in CA. I'm 29. $120/month, urgency 4. Provider is Acme."
     """
-    t = text.lower()
-
-    # coverage
+    # coverage (first whole-word keyword in the text; "car" means auto)
+    m = _coverage(text)
     coverage = None
-    for key in ["life", "auto", "car", "home", "renters", "health", "business"]:
-        if key in t:
-            coverage = "auto" if key == "car" else key
-            break
+    if m:
+        key = m.group(1).lower()
+        coverage = "auto" if key == "car" else key
+
+    present = _fields_present(text)
 
     # budget (prefer amounts near the word "budget"; else fall back to any $amount[/mo])
-    budget = None
-    m = re.search(r"budget[^0-9]{0,12}\$?\s*([0-9]+(?:\.[0-9]{1,2})?)", t)
-    if not m:
-        m = re.search(r"\$\s*([0-9]+(?:\.[0-9]{1,2})?)\s*(?:/mo|per month|monthly)?", t)
-    if m:
-        try:
-            budget = float(m.group(1))
-        except:
-            pass
+    m = _budget(text) if "budget" in present else None
+    if not m and "budget_any" in present:
+        m = _budget_any(text)
+    budget = float(m.group(1)) if m else None
 
     # age (16–99)
-    age = None
-    m = re.search(r"\b(1[6-9]|[2-9][0-9])\b", t)
-    if m:
-        age = int(m.group(1))
+    m = _age(text) if "age" in present else None
+    age = int(m.group(1)) if m else None
 
     # urgency 1–5 (e.g., "urgency 4", "urgency is 4", "4/5")
-    urgency = None
-    m = re.search(r"\burgency\b[^0-9]{0,8}([1-5])\b", t)
-    if not m:
-        m = re.search(r"\b([1-5])\s*(?:/|of)\s*5\b", t)
-    if m:
-        try:
-            urgency = int(m.group(1))
-        except:
-            pass
+    m = _urgency(text) if "urgency" in present else None
+    if not m and "urgency_frac" in present:
+        m = _urgency_frac(text)
+    urgency = int(m.group(1)) if m else None
 
-    # state (prefer "state XX"; otherwise only ALL-CAPS two-letter codes)
+    # state (prefer "state XX"; otherwise the first ALL-CAPS two-letter code that
+    # is a real state, which can't occur in text without capitals)
     state = None
-    m = re.search(r"\bstate[:\s]+([A-Za-z]{2})\b", text, flags=re.IGNORECASE)
+    m = _state_label(text) if "state_label" in present else None
     if m and m.group(1).upper() in STATES:
         state = m.group(1).upper()
-    else:
-        m = re.search(r"\b([A-Z]{2})\b", text)
-        if m and m.group(1).upper() in STATES:
-            state = m.group(1).upper()
+    elif "state_caps" in present and not _no_upper(text):
+        for m in _state_caps(text):
+            if m.group(1) in STATES:
+                state = m.group(1)
+                break
 
     # provider (simple heuristic: "... provider is <word>")
-    provider = None
-    m = re.search(r"provider\s+is\s+([A-Za-z][A-Za-z0-9\- ]{1,40})", t)
-    if m:
-        provider = m.group(1).strip().title()
+    m = _provider(text) if "provider" in present else None
+    provider = m.group(1).strip().title() if m else None
 
     return {
         "coverage": coverage,
@@ -190,23 +291,30 @@ def next_question(entities: dict) -> str | None:
     return None
 
 def score_lead(entities: dict) -> float:
-    score = 0
-    if entities.get("coverage"): score += 1
-    if entities.get("state"): score += 1
-    if entities.get("age"): score += 1
-    if entities.get("budget") is not None: score += 1
-    if entities.get("urgency") is not None: score += 1
-    if (entities.get("budget") or 0) >= 100: score += 1
-    if (entities.get("urgency") or 0) >= 4: score += 1
-    return min(score, 10)
-
-def local_qualifier_reply(user_msg: str) -> str:
+    # One point per collected field, plus one each for budget >= $100 and urgency >= 4
+    budget = entities.get("budget")
+    urgency = entities.get("urgency")
+    return sum((
+        bool(entities.get("coverage")),
+        bool(entities.get("state")),
+        bool(entities.get("age")),
+        budget is not None,
+        urgency is not None,
+        (budget or 0) >= 100,
+        (urgency or 0) >= 4,
+    ))
+
+def local_qualifier_reply(user_msg: str) -> tuple[str, bool]:
+    """
+    Returns (reply, is_terminal). is_terminal is True once every field is
+    collected and the reply is the final scored summary.
+    """
     e = extract_entities(user_msg)
     nq = next_question(e)
     if nq:
         collected = ", ".join(f"{k}={v}" for k, v in e.items() if v not in (None, ""))
         prefix = f"Got it ({collected}). " if collected else ""
-        return prefix + nq
+        return prefix + nq, False
 
     s = score_lead(e)
     return (
@@ -218,43 +326,100 @@ def local_qualifier_reply(user_msg: str) -> str:
         f"- Urgency: {e['urgency']}/5\n"
         f"Lead score: {s}/10.\n"
         "Want me to submit this to an agent and have someone contact you?"
-    )
+    ), True
 # ---------------------------------------------------------------------
 # CRM helper (optional; safe no-op if env vars are missing)
 # ---------------------------------------------------------------------
-async def post_to_crm(lead: dict) -> tuple[str, str]:
+CRM_ATTEMPTS = 3
+CRM_BACKOFF_BASE = 0.25  # seconds; doubles each attempt, plus up to 0.1s jitter
+CRM_MAX_RETRY_AFTER = 10.0  # seconds; a longer Retry-After means give up instead
+
+def _utc_timestamp() -> str:
+    """ISO-8601 UTC time with millisecond precision, e.g. 2024-05-01T12:00:00.123Z."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+def _crm_retry_delay(attempt: int, r: httpx.Response | None = None) -> float | None:
+    """
+    Honor a numeric Retry-After header if present, else exponential backoff + jitter.
+    Returns None (stop retrying) if Retry-After is non-finite or over CRM_MAX_RETRY_AFTER.
+    """
+    if r is not None:
+        try:
+            retry_after = float(r.headers.get("Retry-After", 0))
+        except ValueError:  # HTTP-date form; not worth parsing here
+            retry_after = 0
+        if not math.isfinite(retry_after) or retry_after > CRM_MAX_RETRY_AFTER:
+            return None
+        if retry_after > 0:
+            return retry_after
+    return CRM_BACKOFF_BASE * (2 ** attempt) + random.uniform(0, 0.1)
+
+async def post_to_crm(client: httpx.AsyncClient, lead: dict) -> tuple[str, str]:
     """
     Send the structured lead to a CRM/webhook.
+    Retries connection errors, 5xx and 429 with backoff; other responses are final.
     Returns (status, note) where:
       - status: "sent" | "skipped" | "error"
       - note: short detail (HTTP code, reason, etc.)
     """
-    url = os.getenv("CRM_WEBHOOK_URL", "").strip()
-    api_key = os.getenv("CRM_API_KEY", "").strip()
-
     # If you haven’t set these yet, don’t fail the request—just report "skipped".
-    if not url:
+    if not CRM_WEBHOOK_URL:
         return "skipped", "No CRM_WEBHOOK_URL set"
 
     headers = {"Content-Type": "application/json"}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
+    if CRM_API_KEY:
+        headers["Authorization"] = f"Bearer {CRM_API_KEY}"
 
     payload = {
+        "source": "insurance-lead-qualifier",
+        "timestamp": _utc_timestamp(),
         "lead": lead,
-        "source": "insurance-lead-qualifier"
     }
 
-    try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            r = await client.post(url, json=payload, headers=headers)
+    note = ""
+    for attempt in range(CRM_ATTEMPTS):
+        r = None
+        try:
+            r = await client.post(CRM_WEBHOOK_URL, content=orjson.dumps(payload),
+                                  headers=headers, timeout=10)
+        except httpx.TransportError as e:
+            note = f"exception: {e}"
+        except Exception as e:
+            return "error", f"exception: {e}"
+        else:
+            # Trim body so errors don’t get too big
+            note = f"status={r.status_code} body={r.text[:200]}"
             if 200 <= r.status_code < 300:
                 return "sent", f"{r.status_code}"
-            else:
-                # Trim body so errors don’t get too big
-                return "error", f"status={r.status_code} body={r.text[:200]}"
-    except Exception as e:
-        return "error", f"exception: {e}"
+            if r.status_code < 500 and r.status_code != 429:
+                return "error", note
+
+        if attempt < CRM_ATTEMPTS - 1:
+            delay = _crm_retry_delay(attempt, r)
+            if delay is None:
+                return "error", f"{note} retry_after={r.headers['Retry-After']}"
+            await asyncio.sleep(delay)
+
+    return "error", note
+
+def _log_crm_result(task: asyncio.Task) -> None:
+    """Done-callback for background CRM posts: surface failures in the logs."""
+    _crm_tasks.discard(task)
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        logger.error("CRM post crashed", exc_info=task.exception())
+        return
+    status, note = task.result()
+    if status == "error":
+        logger.warning("CRM post failed: %s", note)
+
+def queue_crm_post(client: httpx.AsyncClient, lead: dict) -> None:
+    """Fire-and-forget post_to_crm so the request doesn't wait on the webhook."""
+    task = asyncio.create_task(post_to_crm(client, lead))
+    _crm_tasks.add(task)
+    task.add_done_callback(_log_crm_result)
 
 # -------------------------------------------------------------------
 # Routes
@@ -264,13 +429,16 @@ async def chat(req: ChatRequest):
     user_msg = req.messages[-1].content if req.messages else ""
 
     # 1) Local rule-based qualifier (no LLM)
-    local = local_qualifier_reply(user_msg)
+    local, is_terminal = local_qualifier_reply(user_msg)
+    if is_terminal:
+        # Nothing left to ask, so the LLM round-trip adds nothing
+        return {"reply": local}
 
     # 2) Try LLM; if it fails (e.g., 429), fall back to local
+    msgs = [_SYS_MSG]
+    msgs.extend({"role": m.role, "content": m.content} for m in req.messages)
     try:
-        llm = await call_openai(
-            [{"role": "system", "content": SYSTEM}] + [m.model_dump() for m in req.messages]
-        )
+        llm = await call_openai(app.state.http, msgs)
         if llm and "[LLM error" not in llm and len(llm.strip()) > 10:
             return {"reply": llm}
     except Exception:
@@ -278,17 +446,40 @@ async def chat(req: ChatRequest):
 
     return {"reply": local}
 
-@app.post("/extract")
-async def extract(payload: dict):
+# The body is read with orjson rather than through FastAPI's stdlib-json parsing,
+# so the schema is declared here to keep it in the generated docs.
+_EXTRACT_BODY = {
+    "required": True,
+    "content": {"application/json": {"schema": {
+        "type": "object",
+        "properties": {"transcript": {"type": "string"}},
+    }}},
+}
+
+@app.post("/extract", openapi_extra={"requestBody": _EXTRACT_BODY})
+async def extract(request: Request, sync: bool = False):
+    try:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {e}")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=422, detail="Body must be a JSON object")
     text = payload.get("transcript", "")
+    if not isinstance(text, str):
+        raise HTTPException(status_code=422, detail="transcript must be a string")
     # produce a structured lead object
     e = extract_entities(text)
     lead = ExtractedLead(**e)
-    # IMPORTANT: score_lead expects a dict
-    lead.score = score_lead(lead.model_dump())
+    lead.score = score_lead(e)
 
-    # Send to CRM/webhook (non-blocking retry inside)
-    status, note = await post_to_crm(lead.model_dump())
+    # Send to CRM/webhook in the background; ?sync=1 waits for the result instead
+    if not CRM_WEBHOOK_URL:
+        status, note = "skipped", "No CRM_WEBHOOK_URL set"
+    elif sync:
+        status, note = await post_to_crm(app.state.http, asdict(lead))
+    else:
+        queue_crm_post(app.state.http, asdict(lead))
+        status, note = "queued", ""
 
     # Map to clean CRM-friendly fields
     out = {